@@ -6,80 +6,260 @@ import scipy
 import json
 import zipfile
 import random
+import warnings
 import collections
 import torch
 import math
 import numpy as np
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
 import torchvision.transforms.functional as F
 import torchvision.transforms as transforms
+from torchvision.io import read_file, decode_image, decode_jpeg, read_video, ImageReadMode
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 from PIL import Image, ImageFilter
 from skimage.color import rgb2gray, gray2rgb
 from core.utils import ZipReader, create_fixed_rectangular_mask, create_random_shape_with_random_motion
-from core.utils import Stack, ToTorchFormatTensor, GroupRandomHorizontalFlip, Normalize
+from core.utils import Stack, ToTorchFormatTensor, Normalize, ShapePool, stack_uint8
+
+# decode_jpeg only reads its input, so the zip bytes are wrapped without a copy;
+# the warning is only muted for calls made from this module
+warnings.filterwarnings('ignore', message='The given buffer is not writable',
+                        category=UserWarning, module=r'core\.dataset$')
+
+
+# Frame counts per video are cached in a side-file so that workers do not
+# re-scan every video directory on start-up. The index is rebuilt when the
+# image directory's mtime changes, i.e. when videos are added or removed.
+def _scan_or_load_index(root_dir, image_dirname, index_name="frames_index.json"):
+    index_path = os.path.join(root_dir, index_name)
+    image_dir = os.path.join(root_dir, image_dirname)
+    image_dir_mtime = os.stat(image_dir).st_mtime_ns
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get("mtime") == image_dir_mtime and "videos" in index:
+            return index["videos"]
+    video_dict = dict()
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                video_dict[entry.name] = len(os.listdir(entry.path))
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({"mtime": image_dir_mtime, "videos": video_dict}, f)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # read-only dataset roots are scanned on every start instead
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return video_dict
+
+
+# Frame names only depend on the frame index, so a single fixed-width byte
+# row is shared by all videos and sliced with the per-video frame count.
+# Flat numpy arrays stay shared copy-on-write with forked loader workers.
+def _build_frame_table(video_ids, video_dict, name_format, start=0):
+    frame_counts = np.array([video_dict[v] for v in video_ids], dtype=np.int32)
+    max_count = int(frame_counts.max()) if len(frame_counts) else 0
+    frame_names = np.array(
+        [name_format.format(i) for i in range(start, start + max_count)], dtype=np.bytes_)
+    return frame_counts, frame_names
+
+
+# Decoding releases the GIL, so the frames of a clip are read concurrently.
+# The pool is created lazily in the process that uses it, since threads do
+# not survive the fork into DataLoader workers.
+def _read_frames(dataset, read_fn, items):
+    if len(items) <= 1:
+        return [read_fn(item) for item in items]
+    if dataset._pool is None or dataset._pool_pid != os.getpid():
+        dataset._pool = ThreadPoolExecutor(max_workers=min(8, len(items)))
+        dataset._pool_pid = os.getpid()
+    return list(dataset._pool.map(read_fn, items))
+
+
+# Videos pre-resized by scripts/build_frame_cache.py are stored as one
+# (T, H, W, 3) uint8 .npy file each and read through a memory map.
+def _list_frame_cache(cache_dir, ext=".npy"):
+    if not os.path.isdir(cache_dir):
+        return set()
+    return {f[:-len(ext)] for f in os.listdir(cache_dir) if f.endswith(ext)}
+
+
+def _read_cached_frames(cache_dir, video_id, indices):
+    video = np.load(os.path.join(cache_dir, f"{video_id}.npy"), mmap_mode='r')
+    frames = torch.from_numpy(video[indices]).permute(0, 3, 1, 2)
+    return list(frames)
+
+
+# Like the thread pool, the generator is created in the process that uses it;
+# DataLoader workers get distinct torch seeds, so their samples differ.
+def _get_rng(dataset):
+    if dataset._rng is None or dataset._rng_pid != os.getpid():
+        dataset._rng = np.random.default_rng(torch.initial_seed() % 2**32)
+        dataset._rng_pid = os.getpid()
+    return dataset._rng
+
+
+# Per-sample uint8 clip buffers are recycled once the batch has been collated,
+# instead of allocating fresh (T, C, H, W) tensors for every sample.
+_sample_buffers = ShapePool()
+
+
+def _stack_pooled(frames):
+    shape = (len(frames),) + tuple(frames[0].shape)
+    return stack_uint8(frames, out=_sample_buffers.get(shape))
+
+
+_reversed_index = dict()
+
+
+def _hflip_pooled(clip):
+    width = clip.shape[-1]
+    if width not in _reversed_index:
+        _reversed_index[width] = torch.arange(width - 1, -1, -1)
+    out = _sample_buffers.get(clip.shape, clip.dtype)
+    torch.index_select(clip, -1, _reversed_index[width], out=out)
+    _sample_buffers.put(clip)
+    return out
+
+
+def pooled_collate(samples):
+    batch = default_collate(samples)
+    for sample in samples:
+        for tensor in sample:
+            _sample_buffers.put(tensor)
+    return batch
+
+
+def worker_init_fn(worker_id):
+    """Seeds a DataLoader worker and warms its per-process caches."""
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+    # frames of a clip are already decoded in parallel by the frame pool
+    cv2.setNumThreads(0)
+    dataset = torch.utils.data.get_worker_info().dataset
+    dataset._rng, dataset._rng_pid = np.random.default_rng(seed), os.getpid()
+    if hasattr(dataset, 'warm'):
+        dataset.warm()
+
+
+# Videos repackaged by scripts/repackage_to_mp4.py are decoded in one pass
+# from the first to the last sampled frame; frame i is at i / ENCODED_FPS.
+# Sparse samples spanning most of a video are read frame by frame instead.
+ENCODED_FPS = 25
+
+try:
+    import av
+    _DECODE_ERRORS = (getattr(av, 'AVError', OSError), OSError, RuntimeError)
+except ImportError:
+    # torchvision raises ImportError from read_video when PyAV is missing
+    _DECODE_ERRORS = (ImportError, OSError, RuntimeError)
+
+
+def _read_encoded_frames(video_path, indices):
+    first, last = indices[0], indices[-1]
+    video, _, _ = read_video(video_path, start_pts=Fraction(first, ENCODED_FPS),
+                             end_pts=Fraction(last, ENCODED_FPS), pts_unit='sec')
+    offsets = [i - first for i in indices]
+    if len(video) <= offsets[-1]:
+        return None
+    return list(video[offsets].permute(0, 3, 1, 2))
+
+
+def _load_clip(dataset, video_id, all_frames, indices):
+    if video_id in dataset.cached_videos:
+        return _read_cached_frames(dataset.cache_dir, video_id, indices)
+    if video_id in dataset.encoded_videos and indices[-1] - indices[0] < 2 * len(indices):
+        try:
+            frames = _read_encoded_frames(os.path.join(dataset.encoded_dir, f"{video_id}.mp4"), indices)
+        except _DECODE_ERRORS:
+            frames = None
+        if frames is not None:
+            return frames
+    return _read_frames(
+        dataset, lambda i: dataset.read_frame(video_id, all_frames[i].decode()), indices)
 
 
 class MUSICDataset(Dataset):
-    def __init__(self, dataset_args: dict, split='train'):
+    def __init__(self, dataset_args: dict, split='train', return_uint8=False):
         self.dataset_args = dataset_args
+        self.return_uint8 = return_uint8
         self.root_dir = dataset_args["root_dir"]
         self.ref_frames = dataset_args["sample_length"]
         self.image_width, self.image_height = dataset_args["w"], dataset_args["h"]
         self.image_shape = (self.image_width, self.image_height)
 
-        self.video_dict = dict()
-        for video_id in os.listdir(f"{self.root_dir}/png"):
-            self.video_dict[video_id] = len(os.listdir(f"{self.root_dir}/png/{video_id}"))
-        self.video_ids = sorted(list(self.video_dict.keys()))
+        self.video_dict = _scan_or_load_index(self.root_dir, "png")
+        self.video_ids = np.array(sorted(list(self.video_dict.keys())))
+        self.frame_counts, self.frame_names = _build_frame_table(
+            self.video_ids, self.video_dict, "{:05d}.png", start=1)
+        self.cache_dir = f"{self.root_dir}/frame_cache_{self.image_width}x{self.image_height}"
+        self.cached_videos = _list_frame_cache(self.cache_dir)
+        self.encoded_dir = f"{self.root_dir}/mp4_{self.image_width}x{self.image_height}"
+        self.encoded_videos = _list_frame_cache(self.encoded_dir, ext=".mp4")
 
-        self.hflipper = transforms.RandomHorizontalFlip(1.)
+        self._pool, self._pool_pid = None, None
+        self._rng, self._rng_pid = None, None
+        # applied to the stacked uint8 frames unless scaling is deferred to the training device
         self.image_transforms = transforms.Compose([
-            Stack(),
             ToTorchFormatTensor(),
             Normalize()
         ])
-        self.mask_transforms = transforms.Compose([
-            Stack(),
-            ToTorchFormatTensor()
-        ])
+        if self.return_uint8:
+            self.mask_transforms = stack_uint8
+        else:
+            self.mask_transforms = transforms.Compose([
+                Stack(),
+                ToTorchFormatTensor()
+            ])
+        # the rectangular mask is the same for every sample
+        self._mask_tensor = self.mask_transforms(create_fixed_rectangular_mask(
+            self.ref_frames, self.image_height, self.image_width, 42))
 
     def __len__(self):
         return len(self.video_ids)
 
     def __getitem__(self, index):  # (B, T, C, H, W)
-        video_id = self.video_ids[index]
-        all_frames = [f"{str(i).zfill(5)}.png" for i in range(1, self.video_dict[video_id] + 1)]
-        sampled_idxs = self.get_frame_index(len(all_frames), self.ref_frames)
-        frames = list()
-        masks = create_fixed_rectangular_mask(5, 256, 256, 42)
-        
-        for i in sampled_idxs:
-            image_path = f"{self.root_dir}/png/{video_id}/{all_frames[i]}"
-            image = Image.open(image_path)
-            assert image.size == self.image_shape
-            frames.append(image)
-        if random.uniform(0, 1) > 0.5:
-            frames = [self.hflipper(frame) for frame in frames]
-
-        frame_tensors = self.image_transforms(frames)  # (T, C, H, W)
-        mask_tensors = self.mask_transforms(masks)
+        video_id, all_frames = self.video_frames(index)
+        # all per-sample coin flips are drawn at once: sparse sampling, hflip
+        coins = _get_rng(self).random(2) > 0.5
+        sampled_idxs = self.get_frame_index(len(all_frames), self.ref_frames, sparse=coins[0])
+        frames = _load_clip(self, video_id, all_frames, sampled_idxs)
+
+        frame_tensors = _stack_pooled(frames)  # (T, C, H, W)
+        if coins[1]:
+            frame_tensors = _hflip_pooled(frame_tensors)
+        if not self.return_uint8:
+            frame_tensors = self.image_transforms(frame_tensors)
+        mask_tensors = self._mask_tensor
         data_dict = frame_tensors, mask_tensors
         return data_dict
 
+    def video_frames(self, index):
+        return self.video_ids[index], self.frame_names[:self.frame_counts[index]]
+
+    def read_frame(self, video_id, frame_name):
+        image_path = f"{self.root_dir}/png/{video_id}/{frame_name}"
+        image = decode_image(read_file(image_path), mode=ImageReadMode.RGB)
+        assert image.shape[-2:] == (self.image_height, self.image_width)
+        return image
+
     # Index sampling function
-    def get_frame_index(self, length, ref_count):
-        if random.uniform(0, 1) > 0.5:
-            ref_index = random.sample(range(length), ref_count)
-            ref_index.sort()
-        else:
-            pivot = random.randint(0, length-ref_count)
-            ref_index = [pivot+i for i in range(ref_count)]
-        return ref_index
+    def get_frame_index(self, length, ref_count, sparse=None):
+        return get_ref_index(length, ref_count, _get_rng(self), sparse)
 
 
 class AVEDataset(Dataset):
-    def __init__(self, args: dict, split="train"):
+    def __init__(self, args: dict, split="train", return_uint8=False):
         self.args = args
+        self.return_uint8 = return_uint8
         self.data_root = args["data_root"]
         self.mask_dir = args["mask_root"]
         self.split = split
@@ -87,20 +267,17 @@ class AVEDataset(Dataset):
         self.image_shape = self.image_width, self.image_height = (args["w"], args["h"])
         assert self.split in ["train", "val", "test"]
 
-        self.video_dict = dict()
-        for video_id in os.listdir(f"{self.data_root}/{split}/image"):
-            self.video_dict[video_id] = len(os.listdir(f"{self.data_root}/{split}/image/{video_id}"))
-        self.video_ids = list(self.video_dict.keys())
+        self.video_dict = _scan_or_load_index(f"{self.data_root}/{split}", "image")
+        self.video_ids = np.array(list(self.video_dict.keys()))
+        self.frame_counts, self.frame_names = _build_frame_table(
+            self.video_ids, self.video_dict, "{:03d}.png")
 
-        self.vflipper = transforms.RandomVerticalFlip(1.)
-        self.hflipper = transforms.RandomHorizontalFlip(1.)
+        self._pool, self._pool_pid = None, None
+        self._rng, self._rng_pid = None, None
 
-        self.mask_transforms = transforms.Compose([
-            Stack(),
-            ToTorchFormatTensor()
-        ])
+        # applied to the stacked uint8 tensors unless scaling is deferred to the training device
+        self.mask_transforms = ToTorchFormatTensor()
         self.image_transforms = transforms.Compose([
-            Stack(),
             ToTorchFormatTensor(),
             Normalize(0.5, 0.5)
         ])
@@ -109,51 +286,55 @@ class AVEDataset(Dataset):
         return len(self.video_ids)
 
     def __getitem__(self, index):
-        video_id = self.video_ids[index]
-        all_frames = [f"{str(i).zfill(3)}.png" for i in range(self.video_dict[video_id])]
-        all_masks = create_random_shape_with_random_motion(len(all_frames), self.image_height, self.image_width)
-        mask_path = f"{self.mask_dir}/{str(random.randrange(0, 12000)).zfill(5)}.png"
+        video_id, all_frames = self.video_frames(index)
+        # all per-sample randomness is drawn at once: mask id, mask hflip,
+        # mask vflip, sparse sampling, frame hflip
+        draws = _get_rng(self).random(5)
+        coins = draws > 0.5
+        mask_path = f"{self.mask_dir}/{str(int(draws[0] * 12000)).zfill(5)}.png"
         mask = Image.open(mask_path).resize((self.image_height, self.image_width)).convert("L")
-        if random.uniform(0, 1) > 0.5:
-            mask = self.hflipper(mask)
-        if random.uniform(0, 1) > 0.5:
-            mask = self.vflipper(mask)
-        all_masks = [mask] * len(all_frames)
-        ref_index = self.get_ref_index(len(all_frames), self.ref_count)
-
-        frames = list()
-        masks = list()
-        for i in ref_index:
-            image_path = f"{self.data_root}/{self.split}/image/{video_id}/{all_frames[i]}"
-            image = Image.open(image_path)
-            if image.size != self.image_shape:
-                image = image.resize(self.image_shape)
-            frames.append(image)
-            masks.append(all_masks[i])
-        
+        mask_tensor = stack_uint8([mask])  # (1, 1, H, W)
+        if coins[1]:
+            mask_tensor = mask_tensor.flip(-1)
+        if coins[2]:
+            mask_tensor = mask_tensor.flip(-2)
+        ref_index = self.get_ref_index(len(all_frames), self.ref_count, sparse=coins[3])
+
+        frames = _read_frames(
+            self, lambda i: self.read_frame(video_id, all_frames[i].decode()), ref_index)
+        frame_tensors = _stack_pooled(frames)
         if self.split == "train":
-            if random.uniform(0, 1) > 0.5:
-                hflip = transforms.RandomHorizontalFlip(1.)
-                frames = [hflip(frame) for frame in frames]
-        
-        frame_tensors = self.image_transforms(frames)
-        mask_tensors = self.mask_transforms(masks)
+            if coins[4]:
+                frame_tensors = _hflip_pooled(frame_tensors)
+        mask_tensors = mask_tensor.expand(len(ref_index), -1, -1, -1)
+
+        if not self.return_uint8:
+            frame_tensors = self.image_transforms(frame_tensors)
+            mask_tensors = self.mask_transforms(mask_tensors)
         return frame_tensors, mask_tensors
 
-    def get_ref_index(self, length, ref_count):
-        if random.uniform(0, 1) > 0.5:
-            ref_index = random.sample(range(length), ref_count)
-            ref_index.sort()
-        else:
-            pivot = random.randint(0, length-ref_count)
-            ref_index = [pivot+i for i in range(ref_count)]
-        return ref_index
+    def video_frames(self, index):
+        return self.video_ids[index], self.frame_names[:self.frame_counts[index]]
+
+    def read_frame(self, video_id, frame_name):
+        image_path = f"{self.data_root}/{self.split}/image/{video_id}/{frame_name}"
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(image_path)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if image.shape[1::-1] != self.image_shape:
+            image = cv2.resize(image, self.image_shape, interpolation=cv2.INTER_AREA)
+        return torch.from_numpy(image).permute(2, 0, 1)
+
+    def get_ref_index(self, length, ref_count, sparse=None):
+        return get_ref_index(length, ref_count, _get_rng(self), sparse)
 
 
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, args: dict, split='train', debug=False):
+    def __init__(self, args: dict, split='train', debug=False, return_uint8=False):
         self.args = args
         self.split = split
+        self.return_uint8 = return_uint8
         self.sample_length = args['sample_length']
         self.size = self.w, self.h = (args['w'], args['h'])
 
@@ -162,7 +343,22 @@ class Dataset(torch.utils.data.Dataset):
         self.video_names = list(self.video_dict.keys())
         if debug or split != 'train':
             self.video_names = self.video_names[:100]
+        self.cache_dir = os.path.join(
+            args['data_root'], args['name'], 'frame_cache_{}x{}'.format(self.w, self.h))
+        self.cached_videos = _list_frame_cache(self.cache_dir)
+        self.encoded_dir = os.path.join(
+            args['data_root'], args['name'], 'mp4_{}x{}'.format(self.w, self.h))
+        self.encoded_videos = _list_frame_cache(self.encoded_dir, ext=".mp4")
+        # drop broken videos once here instead of retrying in __getitem__
+        valid_names = [v for v in self.video_names if self.is_valid_video(v)]
+        if len(valid_names) != len(self.video_names):
+            print('Skipping {} unreadable or too short videos'.format(len(self.video_names) - len(valid_names)))
+        self.video_names = np.array(valid_names)
+        self.frame_counts, self.frame_names = _build_frame_table(
+            self.video_names, self.video_dict, "{:05d}.jpg")
 
+        self._pool, self._pool_pid = None, None
+        self._rng, self._rng_pid = None, None
         self._to_tensors = transforms.Compose([
             Stack(),
             ToTorchFormatTensor(), ])
@@ -171,41 +367,57 @@ class Dataset(torch.utils.data.Dataset):
         return len(self.video_names)
 
     def __getitem__(self, index):
-        try:
-            item = self.load_item(index)
-        except:
-            print('Loading error in video {}'.format(self.video_names[index]))
-            item = self.load_item(0)
-        return item
+        return self.load_item(index)
+
+    def is_valid_video(self, video_name):
+        if self.video_dict[video_name] < self.sample_length:
+            return False
+        return video_name in self.cached_videos or zipfile.is_zipfile(self.zip_path(video_name))
 
     def load_item(self, index):
-        video_name = self.video_names[index]
-        all_frames = [f"{str(i).zfill(5)}.jpg" for i in range(self.video_dict[video_name])]
-        all_masks = create_random_shape_with_random_motion(
-            len(all_frames), imageHeight=self.h, imageWidth=self.w)
-        ref_index = get_ref_index(len(all_frames), self.sample_length)
+        video_name, all_frames = self.video_frames(index)
+        # all per-sample coin flips are drawn at once: sparse sampling, hflip
+        rng = _get_rng(self)
+        coins = rng.random(2) > 0.5
+        ref_index = get_ref_index(len(all_frames), self.sample_length, rng, sparse=coins[0])
+        masks = create_random_shape_with_random_motion(
+            len(all_frames), imageHeight=self.h, imageWidth=self.w, indices=ref_index)
         # read video frames
-        frames = []
-        masks = []
-        for idx in ref_index:
-            img = ZipReader.imread('{}/{}/JPEGImages/{}.zip'.format(
-                self.args['data_root'], self.args['name'], video_name), all_frames[idx]).convert('RGB')
-            img = img.resize(self.size)
-            frames.append(img)
-            masks.append(all_masks[idx])
-        if self.split == 'train':
-            frames = GroupRandomHorizontalFlip()(frames)
+        frames = _load_clip(self, video_name, all_frames, ref_index)
         # To tensors
-        frame_tensors = self._to_tensors(frames)*2.0 - 1.0
-        mask_tensors = self._to_tensors(masks)
+        frame_tensors = _stack_pooled(frames)
+        if self.split == 'train' and coins[1]:
+            frame_tensors = _hflip_pooled(frame_tensors)
+        if self.return_uint8:
+            mask_tensors = stack_uint8(masks)
+        else:
+            frame_tensors = frame_tensors.float().div_(127.5).sub_(1.0)
+            mask_tensors = self._to_tensors(masks)
         return frame_tensors, mask_tensors
 
+    def video_frames(self, index):
+        return self.video_names[index], self.frame_names[:self.frame_counts[index]]
+
+    def zip_path(self, video_name):
+        return '{}/{}/JPEGImages/{}.zip'.format(self.args['data_root'], self.args['name'], video_name)
+
+    def warm(self):
+        ZipReader.warm(self.zip_path(video_name)
+                       for video_name in self.video_names if video_name not in self.cached_videos)
+
+    def read_frame(self, video_name, frame_name):
+        data = ZipReader.read_bytes(self.zip_path(video_name), frame_name)
+        img = decode_jpeg(torch.frombuffer(data, dtype=torch.uint8), mode=ImageReadMode.RGB)
+        return F.resize(img, [self.h, self.w], antialias=True)
+
 
-def get_ref_index(length, sample_length):
-    if random.uniform(0, 1) > 0.5:
-        ref_index = random.sample(range(length), sample_length)
-        ref_index.sort()
+def get_ref_index(length, sample_length, rng=None, sparse=None):
+    rng = np.random.default_rng() if rng is None else rng
+    if sparse is None:
+        sparse = rng.random() > 0.5
+    if sparse:
+        ref_index = np.sort(rng.choice(length, size=sample_length, replace=False)).tolist()
     else:
-        pivot = random.randint(0, length-sample_length)
+        pivot = int(rng.integers(0, length-sample_length+1))
         ref_index = [pivot+i for i in range(sample_length)]
     return ref_index
@@ -1,4 +1,5 @@
 import os
+import sys
 import cv2
 import time
 import math
@@ -24,7 +25,7 @@ from tensorboardX import SummaryWriter
 from torchvision.utils import make_grid, save_image
 import torch.distributed as dist
 
-from core.dataset import Dataset, AVEDataset, MUSICDataset
+from core.dataset import Dataset, AVEDataset, MUSICDataset, pooled_collate, worker_init_fn
 from core.loss import AdversarialLoss
 
 
@@ -39,16 +40,33 @@ class Trainer():
             self.config['trainer']['iterations'] = 5
 
         # setup data set and data loader
-        self.train_dataset = MUSICDataset(config['data_loader'], split='train')
+        self.train_dataset = MUSICDataset(config['data_loader'], split='train', return_uint8=True)
         self.train_sampler = None
         self.train_args = config['trainer']
+        # keep workers (and their open file handles) alive across epochs
+        loader_args = dict()
+        if self.train_args['num_workers'] > 0:
+            loader_args['persistent_workers'] = self.train_args.get('persistent_workers', True)
+            loader_args['prefetch_factor'] = self.train_args.get('prefetch_factor', 4)
+            loader_args['worker_init_fn'] = worker_init_fn
+            if sys.platform.startswith('linux'):
+                # workers share the dataset's index arrays copy-on-write
+                loader_args['multiprocessing_context'] = 'fork'
         self.train_loader = DataLoader(
             self.train_dataset,
             batch_size=self.train_args['batch_size'],
             shuffle=True,
             drop_last=True,
             num_workers=self.train_args['num_workers'],
-            pin_memory=True)
+            collate_fn=pooled_collate,
+            pin_memory=True,
+            **loader_args)
+
+        # uint8 frames from the loader are normalized on the device
+        self.frame_mean = torch.tensor(config['data_loader'].get('mean', 0.5)).view(1, 1, -1, 1, 1)
+        self.frame_std = torch.tensor(config['data_loader'].get('std', 0.5)).view(1, 1, -1, 1, 1)
+        self.frame_mean = self.frame_mean.to(self.config['device'])
+        self.frame_std = self.frame_std.to(self.config['device'])
 
         # set loss functions 
         self.adversarial_loss = AdversarialLoss(type=self.config['losses']['GAN_LOSS'])
@@ -192,15 +210,43 @@ class Trainer():
                 break
         print('\nEnd training....')
 
+    # copy batches to the device; on cuda, the copy of the next batch is
+    # issued on a side stream while the current one is being processed
+    def _device_batches(self):
+        device = torch.device(self.config['device'])
+        if device.type != 'cuda':
+            for batch in self.train_loader:
+                yield [t.to(device) for t in batch]
+            return
+
+        copy_stream = torch.cuda.Stream(device=device)
+        loader_iter = iter(self.train_loader)
+
+        def preload():
+            batch = next(loader_iter, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(copy_stream):
+                return [t.to(device, non_blocking=True) for t in batch]
+
+        next_batch = preload()
+        while next_batch is not None:
+            compute_stream = torch.cuda.current_stream(device)
+            compute_stream.wait_stream(copy_stream)
+            for t in next_batch:
+                t.record_stream(compute_stream)
+            batch, next_batch = next_batch, preload()
+            yield batch
+
     # process input and calculate loss every training epoch
     def _train_epoch(self, pbar):
-        device = self.config['device']
-
-        for frames, masks in self.train_loader:
+        for frames, masks in self._device_batches():
             self.adjust_learning_rate()
             self.iteration += 1
 
-            frames, masks = frames.to(device), masks.to(device)
+            # the loader ships uint8 tensors, so scale them on the device
+            frames = frames.float().div_(255).sub_(self.frame_mean).div_(self.frame_std)
+            masks = masks.float().div_(255)
             b, t, c, h, w = frames.size()
             masked_frame = (frames * (1 - masks).float())
             pred_img = self.netG(masked_frame, masks)
@@ -9,6 +9,10 @@ import argparse
 import shutil
 import random
 import zipfile
+import struct
+import weakref
+import threading
+import collections
 from glob import glob
 import math
 import numpy as np
@@ -30,7 +34,10 @@ matplotlib.use('agg')
 # #####################################################
 
 class ZipReader(object):
+    # path -> (ZipFile, {name: ZipInfo}, {name: data offset}), per process
     file_dict = dict()
+    file_dict_pid = None
+    file_dict_lock = threading.Lock()
 
     def __init__(self):
         super(ZipReader, self).__init__()
@@ -38,18 +45,43 @@ class ZipReader(object):
     @staticmethod
     def build_file_dict(path):
         file_dict = ZipReader.file_dict
-        if path in file_dict:
+        if ZipReader.file_dict_pid == os.getpid() and path in file_dict:
             return file_dict[path]
-        else:
-            file_handle = zipfile.ZipFile(path, 'r')
-            file_dict[path] = file_handle
+        with ZipReader.file_dict_lock:
+            if ZipReader.file_dict_pid != os.getpid():
+                # handles inherited through fork share their file offset with the parent
+                file_dict.clear()
+                ZipReader.file_dict_pid = os.getpid()
+            if path not in file_dict:
+                file_handle = zipfile.ZipFile(path, 'r')
+                infos = {info.filename: info for info in file_handle.infolist()}
+                file_dict[path] = (file_handle, infos, dict())
             return file_dict[path]
 
     @staticmethod
-    def imread(path, image_name):
+    def warm(paths):
+        for path in paths:
+            ZipReader.build_file_dict(path)
+
+    @staticmethod
+    def read_bytes(path, image_name):
         vid_id = path.split("/")[-1].split(".")[0]
-        zfile = ZipReader.build_file_dict(path)
-        data = zfile.read(os.path.join(vid_id, image_name))
+        zfile, infos, offsets = ZipReader.build_file_dict(path)
+        info = infos[os.path.join(vid_id, image_name)]
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return zfile.read(info)
+        # stored members are read straight from the archive without seeking
+        # the shared handle: skip the local file header once, then pread
+        fd = zfile.fp.fileno()
+        if info.filename not in offsets:
+            header = os.pread(fd, 30, info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            offsets[info.filename] = info.header_offset + 30 + name_length + extra_length
+        return os.pread(fd, info.file_size, offsets[info.filename])
+
+    @staticmethod
+    def imread(path, image_name):
+        data = ZipReader.read_bytes(path, image_name)
         im = Image.open(io.BytesIO(data))
         return im
 
@@ -105,7 +137,10 @@ class ToTorchFormatTensor(object):
         self.div = div
 
     def __call__(self, pic):
-        if isinstance(pic, np.ndarray):
+        if isinstance(pic, torch.Tensor):
+            # already stacked uint8 tensor: [L, C, H, W]
+            img = pic
+        elif isinstance(pic, np.ndarray):
             # numpy img: [L, C, H, W]
             img = torch.from_numpy(pic).permute(2, 3, 0, 1).contiguous()
         else:
@@ -120,6 +155,46 @@ class ToTorchFormatTensor(object):
         return img
 
 
+def _pil_to_uint8_tensor(img):
+    if img.mode == '1':
+        img = img.convert('L')
+    array = np.asarray(img)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    return torch.from_numpy(array).permute(2, 0, 1)
+
+
+def stack_uint8(frames, out=None):
+    """ Copies a list of uint8 frames (C x H x W tensors or PIL images) into a
+    single preallocated torch.ByteTensor of shape (L x C x H x W) """
+    frames = [f if isinstance(f, torch.Tensor) else _pil_to_uint8_tensor(f) for f in frames]
+    if out is None:
+        out = torch.empty((len(frames),) + tuple(frames[0].shape), dtype=torch.uint8)
+    for t, frame in enumerate(frames):
+        out[t].copy_(frame)
+    return out
+
+
+class ShapePool(object):
+    """ Hands out reusable tensors keyed by shape and dtype. Only tensors
+    created by the pool are taken back by put(); the others are ignored """
+
+    def __init__(self):
+        self.free = collections.defaultdict(list)
+        self.issued = weakref.WeakValueDictionary()
+
+    def get(self, shape, dtype=torch.uint8):
+        key = (tuple(shape), dtype)
+        tensor = self.free[key].pop() if self.free[key] else torch.empty(key[0], dtype=dtype)
+        self.issued[id(tensor)] = tensor
+        return tensor
+
+    def put(self, tensor):
+        if self.issued.get(id(tensor)) is tensor:
+            del self.issued[id(tensor)]
+            self.free[(tuple(tensor.shape), tensor.dtype)].append(tensor)
+
+
 class Normalize(object):
     def __init__(self, mean=0.5, std=0.5):
         self.mean = mean
@@ -139,7 +214,9 @@ def create_fixed_rectangular_mask(video_length, image_height, image_width, size)
     masks = [Image.fromarray(m).convert("L")] * video_length
     return masks
 
-def create_random_shape_with_random_motion(video_length, imageHeight=240, imageWidth=432):
+def create_random_shape_with_random_motion(video_length, imageHeight=240, imageWidth=432, indices=None):
+    # only the masks of the requested frame indices are rendered;
+    # the motion is simulated up to the last requested frame
     # get a random shape
     height = random.randint(imageHeight//3, imageHeight-1)
     width = random.randint(imageWidth//3, imageWidth-1)
@@ -154,19 +231,23 @@ def create_random_shape_with_random_motion(video_length, imageHeight=240, imageW
     velocity = get_random_velocity(max_speed=3)
     m = Image.fromarray(np.zeros((imageHeight, imageWidth)).astype(np.uint8))
     m.paste(region, (y, x, y+region.size[0], x+region.size[1]))
-    masks = [m.convert('L')]
+    masks = {0: m.convert('L')}
+    if indices is None:
+        indices = range(video_length)
     # return fixed masks
     if random.uniform(0, 1) > 0.5:
-        return masks*video_length
+        return [masks[0]]*len(indices)
     # return moving masks
-    for _ in range(video_length-1):
+    wanted = set(indices)
+    for t in range(1, max(indices, default=0)+1):
         x, y, velocity = random_move_control_points(
             x, y, imageHeight, imageWidth, velocity, region.size, maxLineAcceleration=(3, 0.5), maxInitSpeed=3)
-        m = Image.fromarray(
-            np.zeros((imageHeight, imageWidth)).astype(np.uint8))
-        m.paste(region, (y, x, y+region.size[0], x+region.size[1]))
-        masks.append(m.convert('L'))
-    return masks
+        if t in wanted:
+            m = Image.fromarray(
+                np.zeros((imageHeight, imageWidth)).astype(np.uint8))
+            m.paste(region, (y, x, y+region.size[0], x+region.size[1]))
+            masks[t] = m.convert('L')
+    return [masks[t] for t in indices]
 
 
 def get_random_shape(edge_num=9, ratio=0.7, width=432, height=240):
@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.dataset import Dataset, MUSICDataset
+
+parser = argparse.ArgumentParser(description='Pre-resize video frames into per-video .npy files')
+parser.add_argument('-c', '--config', default='configs/music.json', type=str)
+parser.add_argument('-s', '--split', default='train', type=str)
+args = parser.parse_args()
+
+
+def build_cache(dataset):
+    os.makedirs(dataset.cache_dir, exist_ok=True)
+    for index in tqdm(range(len(dataset)), dynamic_ncols=True):
+        video_id, all_frames = dataset.video_frames(index)
+        cache_path = os.path.join(dataset.cache_dir, f"{video_id}.npy")
+        if os.path.isfile(cache_path):
+            continue
+        frames = [dataset.read_frame(video_id, frame_name.decode()) for frame_name in all_frames]
+        # (T, C, H, W) -> (T, H, W, C) uint8
+        video = torch.stack(frames, dim=0).permute(0, 2, 3, 1).numpy()
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, video)
+        os.replace(tmp_path, cache_path)
+    print('Frame cache written to {}'.format(dataset.cache_dir))
+
+
+if __name__ == '__main__':
+    config = json.load(open(args.config))
+    data_args = config['data_loader']
+    if 'root_dir' in data_args:
+        dataset = MUSICDataset(data_args, split=args.split)
+    else:
+        dataset = Dataset(data_args, split=args.split)
+    build_cache(dataset)
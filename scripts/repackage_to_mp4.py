@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import argparse
+import torch
+from tqdm import tqdm
+from torchvision.io import write_video
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.dataset import Dataset, MUSICDataset, ENCODED_FPS, _read_encoded_frames
+
+parser = argparse.ArgumentParser(description='Repackage video frames into per-video H.264 clips')
+parser.add_argument('-c', '--config', default='configs/music.json', type=str)
+parser.add_argument('-s', '--split', default='train', type=str)
+parser.add_argument('--crf', default=0, type=int)
+args = parser.parse_args()
+
+
+# The dataset picks frame i at pts i / ENCODED_FPS; make sure the encoder did
+# not shift the timestamps by decoding one frame and matching it to its neighbours.
+def check_alignment(video_path, video):
+    if len(video) < 3:
+        return
+    mid = len(video) // 2
+    decoded = _read_encoded_frames(video_path, [mid])
+    if decoded is None:
+        raise RuntimeError('Could not decode frame {} of {}'.format(mid, video_path))
+    decoded = decoded[0].permute(1, 2, 0).float()
+    errors = [(decoded - video[i].float()).abs().mean().item() for i in (mid - 1, mid, mid + 1)]
+    if min(errors) != errors[1]:
+        raise RuntimeError('Frame timestamps of {} are offset from i / {}'.format(video_path, ENCODED_FPS))
+
+
+def repackage(dataset, keyframe_interval):
+    os.makedirs(dataset.encoded_dir, exist_ok=True)
+    # libx264rgb keeps full RGB (no 4:2:0 chroma subsampling), so CRF 0 is lossless;
+    # a keyframe every sample_length frames bounds how far a clip read has to seek back
+    options = {'crf': str(args.crf), 'g': str(keyframe_interval)}
+    for index in tqdm(range(len(dataset)), dynamic_ncols=True):
+        video_id, all_frames = dataset.video_frames(index)
+        video_path = os.path.join(dataset.encoded_dir, f"{video_id}.mp4")
+        if os.path.isfile(video_path):
+            continue
+        frames = [dataset.read_frame(video_id, frame_name.decode()) for frame_name in all_frames]
+        # (T, C, H, W) -> (T, H, W, C) uint8
+        video = torch.stack(frames, dim=0).permute(0, 2, 3, 1)
+        tmp_path = f"{video_path}.tmp.mp4"
+        write_video(tmp_path, video, ENCODED_FPS, video_codec='libx264rgb', options=options)
+        try:
+            check_alignment(tmp_path, video)
+        except RuntimeError:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, video_path)
+    print('Encoded videos written to {}'.format(dataset.encoded_dir))
+
+
+if __name__ == '__main__':
+    config = json.load(open(args.config))
+    data_args = config['data_loader']
+    if 'root_dir' in data_args:
+        dataset = MUSICDataset(data_args, split=args.split)
+    else:
+        dataset = Dataset(data_args, split=args.split)
+    repackage(dataset, data_args['sample_length'])